@@ -1,12 +1,111 @@
 import argparse
+import asyncio
+import gzip
+import json
 import os
-import time
+import sqlite3
+from collections import deque
+from dataclasses import dataclass
 from enum import Enum
+from hashlib import blake2b
 from pathlib import Path
-from typing import Optional
+from typing import Optional, List, Dict, Set, Any, Tuple, TextIO, Deque, Union
 
-from openai import OpenAI, OpenAIError
-from pydantic import BaseModel
+from openai import AsyncOpenAI, OpenAIError
+from openai.types import Batch
+from pydantic import BaseModel, ValidationError
+
+MODEL = "gpt-4o-mini"
+# The largest valid WordInfo JSON is about 20 tokens, the cap leaves room for
+# whitespace and only guards against runaway generation
+MAX_TOKENS = 64
+RETRY_DELAY_SECONDS = 5
+BATCH_POLL_SECONDS = 60
+CACHE_COMMIT_BATCH = 100
+OUTPUT_BUFFER_SIZE = 1 << 16
+OUTPUT_COMPRESS_LEVEL = 3
+OUTPUT_FLUSH_LINES = 256
+# Max lines kept in memory ahead of the first unwritten one
+OUTPUT_WINDOW_SIZE = 1024
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# OpenAI caches prompt prefixes of 1024+ tokens, so everything static lives in the
+# system message and only the word itself is sent in the user message
+PROMPT_CACHE_KEY = "freq_words_info_v1"
+SYSTEM_PROMPT = """You are generating a content for a high quality word learning website.
+
+Your task is to classify a single German word. The word comes from a frequency list \
+of German texts, so it is given exactly as it appears in the list: usually in its \
+dictionary form, sometimes lowercased, sometimes capitalized. You answer with a JSON \
+object with exactly two fields and nothing else.
+
+Field "part_of_speech" is one of:
+- "noun": a German noun (Substantiv), including proper nouns that have a grammatical \
+gender, nominalized adjectives and nominalized verbs (das Essen, der Alte).
+- "verb": a German verb (Verb) in any form, including modal and auxiliary verbs \
+(sein, haben, werden, können, müssen) and separable verbs (anfangen, aufstehen).
+- "adjective": a German adjective (Adjektiv), including participles that are mostly \
+used as adjectives (bekannt, interessant) and declined adjective forms (großen, kleine).
+- "adverb": a German adverb (Adverb), including adverbs of time, place, manner and \
+degree (heute, dort, gern, sehr) and pronominal adverbs (darauf, damit, wofür).
+- "other": everything else: articles, pronouns, prepositions, conjunctions, \
+particles, numerals, interjections, abbreviations and foreign fragments.
+
+Field "gender" is one of:
+- "male": the noun takes the article "der" in nominative singular.
+- "female": the noun takes the article "die" in nominative singular.
+- "neutral": the noun takes the article "das" in nominative singular.
+- null: the word is not a noun, or it is a noun that is only used in plural \
+(die Leute, die Eltern, die Ferien) and has no singular gender.
+
+Rules:
+1. Classify by the most frequent usage of the word in modern standard German.
+2. If the word can be both a noun and another part of speech, the capitalization \
+decides: a capitalized word is a noun (Essen, Leben), a lowercase word is not \
+(essen, leben).
+3. If a noun has several genders depending on meaning (der See / die See, \
+der Band / das Band), choose the gender of the most frequent meaning.
+4. Compound nouns take the gender of their last component \
+(die Haustür, der Kindergarten, das Wörterbuch).
+5. Nouns ending in -ung, -heit, -keit, -schaft, -ion, -tät, -ik are usually female; \
+nouns ending in -chen, -lein, -ment, -um are usually neutral; nouns ending in -ling, \
+-ismus, -or are usually male. Use these only when you are not sure otherwise.
+6. Inflected forms are classified by their dictionary form: "ging" is a verb, \
+"Häuser" is a neutral noun, "schönsten" is an adjective.
+7. Gender must be null for every word that is not a noun.
+8. Never add explanations, comments or additional fields.
+
+Examples:
+- "Haus" -> {"part_of_speech": "noun", "gender": "neutral"}
+- "Tisch" -> {"part_of_speech": "noun", "gender": "male"}
+- "Zeitung" -> {"part_of_speech": "noun", "gender": "female"}
+- "Mädchen" -> {"part_of_speech": "noun", "gender": "neutral"}
+- "Frau" -> {"part_of_speech": "noun", "gender": "female"}
+- "Mann" -> {"part_of_speech": "noun", "gender": "male"}
+- "Leute" -> {"part_of_speech": "noun", "gender": null}
+- "Freiheit" -> {"part_of_speech": "noun", "gender": "female"}
+- "Schmetterling" -> {"part_of_speech": "noun", "gender": "male"}
+- "Museum" -> {"part_of_speech": "noun", "gender": "neutral"}
+- "Essen" -> {"part_of_speech": "noun", "gender": "neutral"}
+- "essen" -> {"part_of_speech": "verb", "gender": null}
+- "gehen" -> {"part_of_speech": "verb", "gender": null}
+- "ging" -> {"part_of_speech": "verb", "gender": null}
+- "können" -> {"part_of_speech": "verb", "gender": null}
+- "aufstehen" -> {"part_of_speech": "verb", "gender": null}
+- "schön" -> {"part_of_speech": "adjective", "gender": null}
+- "großen" -> {"part_of_speech": "adjective", "gender": null}
+- "bekannt" -> {"part_of_speech": "adjective", "gender": null}
+- "heute" -> {"part_of_speech": "adverb", "gender": null}
+- "sehr" -> {"part_of_speech": "adverb", "gender": null}
+- "darauf" -> {"part_of_speech": "adverb", "gender": null}
+- "gern" -> {"part_of_speech": "adverb", "gender": null}
+- "und" -> {"part_of_speech": "other", "gender": null}
+- "der" -> {"part_of_speech": "other", "gender": null}
+- "mit" -> {"part_of_speech": "other", "gender": null}
+- "ich" -> {"part_of_speech": "other", "gender": null}
+- "zwei" -> {"part_of_speech": "other", "gender": null}
+- "ja" -> {"part_of_speech": "other", "gender": null}
+- "usw" -> {"part_of_speech": "other", "gender": null}
+"""
 
 
 class Gender(Enum):
@@ -28,73 +127,398 @@ class WordInfo(BaseModel):
     gender: Optional[Gender]
 
 
+WORD_INFO_RESPONSE_FORMAT: Dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "WordInfo",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "part_of_speech": {
+                    "type": "string",
+                    "enum": [x.value for x in PartOfSpeech],
+                },
+                "gender": {
+                    "type": ["string", "null"],
+                    "enum": [x.value for x in Gender] + [None],
+                },
+            },
+            "required": ["part_of_speech", "gender"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+@dataclass
+class FreqLine:
+    i: int
+    line: str
+    word: str
+    freq: float
+    is_top: bool
+
+
+class WordInfoCache:
+    def __init__(self, path: Path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, pos TEXT, gender TEXT)",
+        )
+        self._key_prefix = blake2b(f"{MODEL}|{SYSTEM_PROMPT}|".encode("utf-8"))
+        self._pending: List[Tuple[str, str, Optional[str]]] = []
+
+    def _make_key(self, word: str) -> str:
+        key = self._key_prefix.copy()
+        key.update(word.encode("utf-8"))
+        return key.hexdigest()
+
+    def get(self, word: str) -> Optional[WordInfo]:
+        row = self.connection.execute(
+            "SELECT pos, gender FROM cache WHERE key = ?", (self._make_key(word),),
+        ).fetchone()
+        if row is None:
+            return None
+        return WordInfo(
+            part_of_speech=PartOfSpeech(row[0]),
+            gender=Gender(row[1]) if row[1] else None,
+        )
+
+    def put(self, word: str, word_info: WordInfo):
+        self._pending.append((
+            self._make_key(word),
+            word_info.part_of_speech.value,
+            word_info.gender.value if word_info.gender is not None else None,
+        ))
+        if len(self._pending) >= CACHE_COMMIT_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, pos, gender) VALUES (?, ?, ?)",
+                self._pending,
+            )
+            self.connection.commit()
+            self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def open_output(output_file: Path, mode: str) -> TextIO:
+    # Output files named *.gz are gzip-compressed, appending adds a new gzip member
+    if output_file.suffix == ".gz":
+        return gzip.open(output_file, mode + "t", compresslevel=OUTPUT_COMPRESS_LEVEL)
+    return open(output_file, mode, buffering=OUTPUT_BUFFER_SIZE)
+
+
+def read_freq_lines(freq_file: Path, start_line: int) -> List[FreqLine]:
+    result: List[FreqLine] = []
+    with open(freq_file, "r") as f:
+        for i, line in enumerate(f):
+            if i < start_line:
+                continue
+            line = line.strip()
+            if line and not line.startswith("#"):
+                parts = line.split(";")
+                if len(parts) != 4:
+                    raise ValueError("Invalid line {} '{}'".format(i, line))
+                result.append(FreqLine(
+                    i=i,
+                    line=line,
+                    word=parts[0],
+                    freq=float(parts[1]),
+                    is_top=parts[2] == "1",
+                ))
+    return result
+
+
+def read_done_lines(output_file: Path) -> Set[int]:
+    if not output_file.exists():
+        return set()
+    result: Set[int] = set()
+    with open_output(output_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                result.add(int(line.split(";", 1)[0]))
+    return result
+
+
+def make_completion_params(word: str) -> Dict[str, Any]:
+    return {
+        "model": MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": "Info about german word '{}'".format(word),
+            },
+        ],
+        "response_format": WORD_INFO_RESPONSE_FORMAT,
+        "prompt_cache_key": PROMPT_CACHE_KEY,
+        "max_tokens": MAX_TOKENS,
+        "n": 1,
+    }
+
+
+async def fetch_word_info(
+    openai: AsyncOpenAI,
+    semaphore: asyncio.Semaphore,
+    cache: WordInfoCache,
+    freq_line: FreqLine,
+) -> Optional[WordInfo]:
+    if not freq_line.is_top:
+        return None
+    cached = cache.get(freq_line.word)
+    if cached is not None:
+        return cached
+    async with semaphore:
+        while True:
+            print("LLM for line {}".format(freq_line.i))
+            try:
+                data = await openai.chat.completions.create(
+                    **make_completion_params(freq_line.word),
+                )
+            except OpenAIError as e:
+                print("Error for line {} '{}': {}. Retrying..".format(
+                    freq_line.i, freq_line.line, e,
+                ))
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+                continue
+            choice = data.choices[0]
+            # Truncated or malformed output is retried like an API error
+            if choice.finish_reason == "length" or choice.message.content is None:
+                print("No complete LLM data for line {} '{}'. Retrying..".format(
+                    freq_line.i, freq_line.line,
+                ))
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+                continue
+            try:
+                llm_data = WordInfo.model_validate_json(choice.message.content)
+            except ValidationError as e:
+                print("Invalid LLM data for line {} '{}': {}. Retrying..".format(
+                    freq_line.i, freq_line.line, e,
+                ))
+                await asyncio.sleep(RETRY_DELAY_SECONDS)
+                continue
+            cache.put(freq_line.word, llm_data)
+            return llm_data
+
+
+def format_output_line(freq_line: FreqLine, word_info: Optional[WordInfo]) -> str:
+    if word_info is not None:
+        part_of_speech = word_info.part_of_speech.value
+        gender = word_info.gender.value if word_info.gender is not None else ""
+    else:
+        part_of_speech = ""
+        gender = ""
+    is_top = 1 if freq_line.is_top else 0
+    return f"{freq_line.i};{freq_line.word};{freq_line.freq};{is_top};{part_of_speech};{gender}\n"
+
+
+class OutputWriter:
+    def __init__(self, output_file: Path):
+        self.output_file = output_file
+        self._f_out: Optional[TextIO] = None
+        self._buffer: List[str] = []
+
+    def __enter__(self) -> "OutputWriter":
+        self._f_out = open_output(self.output_file, "a")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        self._f_out.close()
+
+    def write(self, line: str):
+        self._buffer.append(line)
+        if len(self._buffer) >= OUTPUT_FLUSH_LINES:
+            self.flush()
+
+    def flush(self):
+        self._f_out.writelines(self._buffer)
+        self._buffer.clear()
+
+
+def make_batch_request(freq_line: FreqLine) -> str:
+    return json.dumps({
+        "custom_id": str(freq_line.i),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": make_completion_params(freq_line.word),
+    }) + "\n"
+
+
+def parse_batch_output(content: str) -> Dict[int, WordInfo]:
+    result: Dict[int, WordInfo] = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        i = int(record["custom_id"])
+        response = record.get("response")
+        if record.get("error") is not None or response is None or response["status_code"] != 200:
+            print("Error for line {}: {}. Skipping..".format(i, record.get("error") or response))
+            continue
+        choice = response["body"]["choices"][0]
+        if choice.get("finish_reason") == "length":
+            print("Truncated LLM data for line {}. Skipping..".format(i))
+            continue
+        try:
+            result[i] = WordInfo.model_validate_json(choice["message"]["content"] or "")
+        except ValidationError as e:
+            print("Invalid LLM data for line {}: {}. Skipping..".format(i, e))
+    return result
+
+
+async def create_batch(openai: AsyncOpenAI, freq_lines: List[FreqLine]) -> Optional[Batch]:
+    batch_input = "".join(
+        make_batch_request(freq_line) for freq_line in freq_lines if freq_line.is_top
+    )
+    if not batch_input:
+        return None
+    batch_file = await openai.files.create(
+        file=("freq_words_info.jsonl", batch_input.encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await openai.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print("Created batch {}".format(batch.id))
+    return batch
+
+
+async def wait_batch(openai: AsyncOpenAI, batch: Batch) -> Dict[int, WordInfo]:
+    while batch.status not in BATCH_FINAL_STATUSES:
+        print("Batch {} is {}, waiting..".format(batch.id, batch.status))
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await openai.batches.retrieve(batch.id)
+    if batch.status != "completed" or batch.output_file_id is None:
+        raise Exception("Batch {} finished with status {}".format(batch.id, batch.status))
+    output = await openai.files.content(batch.output_file_id)
+    return parse_batch_output(output.text)
+
+
+async def run_batch(
+    args: argparse.Namespace,
+    openai: AsyncOpenAI,
+    cache: WordInfoCache,
+    freq_lines: List[FreqLine],
+):
+    done_lines = read_done_lines(args.output_file)
+    freq_lines = [freq_line for freq_line in freq_lines if freq_line.i not in done_lines]
+
+    word_infos: Dict[int, WordInfo] = {}
+    for freq_line in freq_lines:
+        if freq_line.is_top:
+            cached = cache.get(freq_line.word)
+            if cached is not None:
+                word_infos[freq_line.i] = cached
+
+    if args.batch_id is not None:
+        batch = await openai.batches.retrieve(args.batch_id)
+    else:
+        batch = await create_batch(
+            openai, [freq_line for freq_line in freq_lines if freq_line.i not in word_infos],
+        )
+    if batch is not None:
+        batch_word_infos = await wait_batch(openai, batch)
+        for freq_line in freq_lines:
+            if freq_line.i in batch_word_infos:
+                cache.put(freq_line.word, batch_word_infos[freq_line.i])
+        word_infos.update(batch_word_infos)
+
+    with OutputWriter(args.output_file) as writer:
+        for freq_line in freq_lines:
+            if not freq_line.is_top or freq_line.i in word_infos:
+                writer.write(format_output_line(freq_line, word_infos.get(freq_line.i)))
+
+
+async def fetch_output_line(
+    openai: AsyncOpenAI,
+    semaphore: asyncio.Semaphore,
+    cache: WordInfoCache,
+    freq_line: FreqLine,
+) -> str:
+    word_info = await fetch_word_info(openai, semaphore, cache, freq_line)
+    return format_output_line(freq_line, word_info)
+
+
+async def _pop_output_line(window: Deque[Union[str, asyncio.Task[str]]]) -> str:
+    item = window[0]
+    if isinstance(item, asyncio.Task):
+        item = await item
+    window.popleft()
+    return item
+
+
+async def run_requests(
+    args: argparse.Namespace,
+    openai: AsyncOpenAI,
+    cache: WordInfoCache,
+    freq_lines: List[FreqLine],
+):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    # Rows are written in input order as soon as the first one in the window is ready.
+    # Top lines are fetched in tasks, other lines need no request and are kept formatted
+    window: Deque[Union[str, asyncio.Task[str]]] = deque()
+    window_size = args.concurrency + OUTPUT_WINDOW_SIZE
+    with OutputWriter(args.output_file) as writer:
+        try:
+            for freq_line in freq_lines:
+                if freq_line.is_top:
+                    window.append(asyncio.create_task(
+                        fetch_output_line(openai, semaphore, cache, freq_line),
+                    ))
+                else:
+                    window.append(format_output_line(freq_line, None))
+                while len(window) > window_size:
+                    writer.write(await _pop_output_line(window))
+            while window:
+                writer.write(await _pop_output_line(window))
+        finally:
+            for item in window:
+                if isinstance(item, asyncio.Task):
+                    item.cancel()
+
+
+async def run(args: argparse.Namespace, openai_key: str):
+    openai = AsyncOpenAI(api_key=openai_key)
+    freq_lines = read_freq_lines(args.freq_file, args.line)
+    cache = WordInfoCache(args.cache_file)
+    try:
+        if args.batch or args.batch_id is not None:
+            await run_batch(args, openai, cache, freq_lines)
+        else:
+            await run_requests(args, openai, cache, freq_lines)
+    finally:
+        cache.close()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--freq-file", type=Path, required=True)
     parser.add_argument("--output-file", type=Path, required=True)
     parser.add_argument("--line", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--cache-file", type=Path, default=Path(".word_info_cache.db"))
+    parser.add_argument("--batch", action="store_true", help="Use OpenAI Batch API")
+    parser.add_argument("--batch-id", type=str, help="Resume waiting for an existing batch")
     args = parser.parse_args()
     openai_key = os.environ.get("OPENAI_API_KEY")
     if openai_key is None:
         raise ValueError("OPENAI_API_KEY is not set")
 
-    openai = OpenAI(api_key=openai_key)
-
-    with open(args.freq_file, "r") as f:
-        with open(args.output_file, "a+") as f_out:
-            for i, line in enumerate(f):
-                if i < args.line:
-                    continue
-                line = line.strip()
-                if line and not line.startswith("#"):
-                    parts = line.split(";")
-                    if len(parts) != 4:
-                        raise ValueError("Invalid line {} '{}'".format(i, line))
-                    word = parts[0]
-                    freq = float(parts[1])
-                    is_top = parts[2] == "1"
-                    if is_top:
-                        while True:
-                            print("LLM for line {}".format(i))
-                            try:
-                                data = openai.beta.chat.completions.parse(
-                                    model="gpt-4o",
-                                    messages=[
-                                        {
-                                            "role": "system",
-                                            "content": "You are generating a content for a "
-                                                       "high quality word learning website.",
-                                        },
-                                        {
-                                            "role": "user",
-                                            "content": "Info about german word '{}'".format(word),
-                                        },
-                                    ],
-                                    response_format=WordInfo,
-                                    n=1,
-                                )
-                            except OpenAIError as e:
-                                print("Error for line {} '{}': {}. Retrying..".format(i, line, e))
-                                time.sleep(5)
-                                continue
-                            llm_data = data.choices[0].message.parsed
-                            if llm_data is None:
-                                raise Exception("No LLM data for line {} '{}'".format(i, line))
-                            gender = llm_data.gender
-                            part_of_speech = llm_data.part_of_speech
-                            break
-                    else:
-                        gender = None
-                        part_of_speech = None
-
-                    f_out.write("{};{};{};{};{};{}\n".format(
-                        i,
-                        word,
-                        freq,
-                        1 if is_top else 0,
-                        part_of_speech.value if part_of_speech is not None else "",
-                        gender.value if gender is not None else "",
-                    ))
+    asyncio.run(run(args, openai_key))
 
 
 if __name__ == "__main__":
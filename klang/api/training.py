@@ -1,8 +1,10 @@
 from contextlib import asynccontextmanager
 from typing import Optional, AsyncIterator
 
+from dishka.integrations.fastapi import inject
 from fastapi import FastAPI
 from pydantic import BaseModel
+from sqlalchemy import bindparam
 from sqlmodel import delete, col, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
@@ -16,6 +18,21 @@ from klang.word_training import (
     success_word,
     next_task,
     TTask, check_finished,
+    ensure_distractor_pool,
+)
+
+
+# Statements are built once and bound with params per request
+USER_WORD_TRAINING_QUERY = select(UserTraining).where(
+    UserTraining.user_id == bindparam("user_id"),
+    col(UserTraining.training_type) == "word",
+)
+USER_WORD_TRAINING_BY_ID_QUERY = USER_WORD_TRAINING_QUERY.where(
+    UserTraining.id == bindparam("training_id"),
+)
+DELETE_USER_WORD_TRAINING_QUERY = delete(UserTraining).where(
+    UserTraining.user_id == bindparam("user_id"),
+    col(UserTraining.training_type) == "word",
 )
 
 
@@ -35,21 +52,20 @@ class WordIn(BaseModel):
 
 def bind_training_api(app: FastAPI):
     @app.get("/training/word")
+    @inject
     async def create_word_training(
         session: SessionDep,
         user: UserDep,
     ) -> Optional[TrainingOut]:
-        query = select(UserTraining).where(
-            UserTraining.user_id == user.user.id,
-            col(UserTraining.training_type) == "word",
-        )
-        db_training = (await session.exec(query)).first()
+        query_params = {"user_id": user.user.id}
+        db_training = (await session.exec(USER_WORD_TRAINING_QUERY, params=query_params)).first()
         if db_training is None:
             return None
         else:
             return TrainingOut(training_id=db_training.id)
 
     @app.post("/training/word")
+    @inject
     async def create_word_training(
         session: SessionDep,
         user: UserDep,
@@ -58,11 +74,7 @@ def bind_training_api(app: FastAPI):
         training = await new_word_training(
             session=session, n_words=data.n_words, include_old=data.include_old, user=user,
         )
-        query = delete(UserTraining).where(
-            UserTraining.user_id == user.user.id,
-            col(UserTraining.training_type) == "word",
-        )
-        await session.exec(query)
+        await session.exec(DELETE_USER_WORD_TRAINING_QUERY, params={"user_id": user.user.id})
 
         db_training = UserTraining(
             user_id=user.user.id,
@@ -79,22 +91,22 @@ def bind_training_api(app: FastAPI):
     async def _load_training(
         session: AsyncSession, user: UserData, training_id: int, save: bool = True,
     ) -> AsyncIterator[WordTraining]:
-        query = select(UserTraining).where(
-            UserTraining.user_id == user.user.id,
-            col(UserTraining.training_type) == "word",
-            UserTraining.id == training_id,
-        )
-        db_training = (await session.exec(query)).first()
+        query_params = {"user_id": user.user.id, "training_id": training_id}
+        db_training = (
+            await session.exec(USER_WORD_TRAINING_BY_ID_QUERY, params=query_params)
+        ).first()
         if db_training is None:
             raise ValueError(f"Training {training_id} not found")
         training = WordTraining.model_validate_json(db_training.training_data)
+        pool_loaded = await ensure_distractor_pool(session, training)
         yield training
-        if save:
+        if save or pool_loaded:
             db_training.training_data = training.model_dump_json()
             await session.commit()
             await session.refresh(db_training)
 
     @app.post("/training/word/error")
+    @inject
     async def error_word_training(
         session: SessionDep,
         user: UserDep,
@@ -104,6 +116,7 @@ def bind_training_api(app: FastAPI):
             await fail_word(vocabulary_id=data.vocabulary_id, training=training)
 
     @app.post("/training/word/success")
+    @inject
     async def success_word_training(
         session: SessionDep,
         user: UserDep,
@@ -113,15 +126,17 @@ def bind_training_api(app: FastAPI):
             await success_word(vocabulary_id=data.vocabulary_id, training=training)
 
     @app.get("/training/word/next")
+    @inject
     async def get_next_word_training(
         session: SessionDep,
         user: UserDep,
         training_id: int,
     ) -> TTask:
         async with _load_training(session, user, training_id, save=False) as training:
-            return await next_task(session, training)
+            return await next_task(training)
 
     @app.get("/training/word/complete")
+    @inject
     async def complete_word_training(
         session: SessionDep,
         user: UserDep,
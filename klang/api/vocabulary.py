@@ -1,10 +1,12 @@
 from typing import List, Dict
 
+from cachetools import TTLCache
 from dishka import FromDishka
 from dishka.integrations.fastapi import inject
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from openai import BaseModel
-from sqlmodel import select
+from sqlalchemy import bindparam
+from sqlmodel import select, col
 
 from klang.api.common import UserDep
 from klang.config import Config
@@ -16,27 +18,55 @@ from fastapi.staticfiles import StaticFiles
 
 from klang.storage import Storage
 
+LEXICON_SEARCH_LIMIT = 50
+# Lexicon is only written on the first boot, so search results stay valid for long
+LEXICON_CACHE_TTL_SECONDS = 3600
+
+_lexicon_search_cache: TTLCache[str, List[str]] = TTLCache(
+    maxsize=10_000, ttl=LEXICON_CACHE_TTL_SECONDS,
+)
+
+# Statements are built once and bound with params per request.
+# Search returns the most frequent matches first, so the limited result is stable
+LEXICON_SEARCH_QUERY = select(Lexicon).where(
+    col(Lexicon.word).like(bindparam("prefix")),
+).order_by(col(Lexicon.frequency).desc()).limit(LEXICON_SEARCH_LIMIT)
+MEANINGS_BY_WORD_QUERY = select(WordMeaning).where(WordMeaning.word == bindparam("word"))
+ADDED_MEANING_IDS_QUERY = select(Vocabulary.word_meaning_id).where(
+    col(Vocabulary.word_meaning_id).in_(bindparam("meaning_ids", expanding=True)),
+)
+USER_VOCABULARY_QUERY = select(Vocabulary).where(Vocabulary.user_id == bindparam("user_id"))
+
 
 def bind_vocabulary_api(app: FastAPI, config: Config):
-    app.mount(
-        "/api/lexicon/illustrations",
-        StaticFiles(directory=config.illustrations_dir),
-        name="lexicon_illustrations",
-    )
-    app.mount(
-        "/api/lexicon/sounds",
-        StaticFiles(directory=config.sounds_dir),
-        name="lexicon_sounds",
-    )
+    if config.serve_static_files:
+        app.mount(
+            "/api/lexicon/illustrations",
+            StaticFiles(directory=config.illustrations_dir),
+            name="lexicon_illustrations",
+        )
+        app.mount(
+            "/api/lexicon/sounds",
+            StaticFiles(directory=config.sounds_dir),
+            name="lexicon_sounds",
+        )
 
     @app.get("/api/lexicon/search")
+    @inject
     async def lexicon_search(
         session: SessionDep,
         _user_data: UserDep,
+        response: Response,
         query: str,
     ) -> List[str]:
-        sql_query = select(Lexicon).where(Lexicon.word.like(f"{query}%"))
-        return [row.word for row in (await session.exec(sql_query))]
+        response.headers["Cache-Control"] = f"private, max-age={LEXICON_CACHE_TTL_SECONDS}"
+        words = _lexicon_search_cache.get(query)
+        if words is None:
+            query_params = {"prefix": f"{query}%"}
+            rows = await session.exec(LEXICON_SEARCH_QUERY, params=query_params)
+            words = [row.word for row in rows]
+            _lexicon_search_cache[query] = words
+        return words
 
     class WordMeaningOut(BaseModel):
         full_word: str
@@ -53,8 +83,7 @@ def bind_vocabulary_api(app: FastAPI, config: Config):
         word: str,
         llm: bool = False,
     ) -> List[WordMeaningOut]:
-        sql_query = select(WordMeaning).where(WordMeaning.word == word)
-        meanings = (await session.exec(sql_query)).all()
+        meanings = (await session.exec(MEANINGS_BY_WORD_QUERY, params={"word": word})).all()
         if len(meanings) == 0:
             if llm:
                 meanings = await llm_client.wait_word_meanings(session, word)
@@ -62,14 +91,17 @@ def bind_vocabulary_api(app: FastAPI, config: Config):
                 raise HTTPException(
                     status_code=404, detail="Init required", headers={"X-Init-Required": "true"},
                 )
+        query_params = {"meaning_ids": [meaning.id for meaning in meanings]}
+        added_ids = set((await session.exec(ADDED_MEANING_IDS_QUERY, params=query_params)).all())
         result = []
         for meaning in meanings:
-            sql_query = select(Vocabulary).where(Vocabulary.word_meaning_id == meaning.id)
-            added = bool((await session.exec(sql_query)).first())
             translations = {x.language: x for x in meaning.translations}
             full_word = make_full_word(meaning)
             result.append(WordMeaningOut(
-                full_word=full_word, meaning=meaning, added=added, translations=translations,
+                full_word=full_word,
+                meaning=meaning,
+                added=meaning.id in added_ids,
+                translations=translations,
             ))
 
         return result
@@ -122,17 +154,19 @@ def bind_vocabulary_api(app: FastAPI, config: Config):
             return True
 
     @app.get("/api/vocabulary")
+    @inject
     async def vocabulary(
         session: SessionDep,
         user_data: UserDep,
     ) -> List[Vocabulary]:
-        sql_query = select(Vocabulary).where(Vocabulary.user_id == user_data.user.id)
-        return (await session.exec(sql_query)).all()
+        query_params = {"user_id": user_data.user.id}
+        return (await session.exec(USER_VOCABULARY_QUERY, params=query_params)).all()
 
     class AddVocabularyIn(BaseModel):
         meaning_id: int
 
     @app.put("/api/vocabulary")
+    @inject
     async def add_vocabulary(
         session: SessionDep,
         user_data: UserDep,
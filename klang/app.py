@@ -2,18 +2,26 @@ from contextlib import asynccontextmanager
 
 from dishka import AsyncContainer
 from fastapi import FastAPI
+from sqlalchemy.ext.asyncio import AsyncEngine
 
 from klang.api.oauth import bind_oauth_api
 from klang.api.training import bind_training_api
 from klang.api.vocabulary import bind_vocabulary_api
 from klang.config import Config
 from klang.db import create_db_and_tables
+from klang.llm import LLMClient
+from klang.storage import Storage
 
 
 @asynccontextmanager
-async def lifespan(_app: FastAPI):
-    await create_db_and_tables()
+async def lifespan(app: FastAPI):
+    container: AsyncContainer = app.state.dishka_container
+    await create_db_and_tables(await container.get(AsyncEngine))
+    # Build app-lifetime dependencies at startup, not on the first request using them
+    await container.get(LLMClient)
+    await container.get(Storage)
     yield
+    await container.close()
 
 
 def create_app(config: Config) -> FastAPI:
@@ -2,7 +2,7 @@ from pathlib import Path
 from typing import Optional
 
 import yaml
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class DBConfig(BaseModel):
@@ -11,6 +11,12 @@ class DBConfig(BaseModel):
     user: str
     password: str
     db: str
+    pool_size: int = 20
+    max_overflow: int = 30
+    pool_timeout: int = 30
+    pool_recycle: int = 1800
+    pool_pre_ping: bool = True
+    pool_use_lifo: bool = True
 
 
 class OAuthClientConfig(BaseModel):
@@ -23,6 +29,17 @@ class OAuthClientConfig(BaseModel):
     logout_uri: str
 
 
+class LLMConfig(BaseModel):
+    # Max queued sound tasks a worker fetches concurrently with one DB session and commit
+    batch_size: int = 8
+    meaning_workers: int = 4
+    illustration_workers: int = 2
+    sound_workers: int = 4
+    # In-flight request limits shared by all workers
+    openai_concurrency: int = 8
+    narakeet_concurrency: int = 16
+
+
 class Config(BaseModel):
     db: DBConfig
     oauth_client: OAuthClientConfig
@@ -30,6 +47,9 @@ class Config(BaseModel):
     narakeet_key: str
     illustrations_dir: Path
     sounds_dir: Path
+    llm: LLMConfig = Field(default_factory=LLMConfig)
+    # Disable when illustrations and sounds are served by a reverse proxy
+    serve_static_files: bool = True
     listen_host: str = "127.0.0.1"
     listen_port: int = 8088
 
@@ -1,79 +1,90 @@
+import csv
+import gzip
 import logging
-from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional, Annotated, AsyncGenerator
+from typing import Optional, Generator, Tuple, TextIO
 
-from fastapi import Depends
-from sqlalchemy import create_engine, text
-from sqlalchemy.ext.asyncio import AsyncEngine
-from sqlalchemy.orm import sessionmaker
+from dishka import FromDishka
+from sqlalchemy import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlmodel import SQLModel, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from klang.config import DBConfig
 from klang.models import Lexicon
 
-engine: Optional[AsyncEngine] = None
-async_session: Optional[sessionmaker] = None
-
 log = logging.getLogger(__name__)
 
+LEXICON_PATH = Path(__file__).parent.parent / "data/full_words.csv"
+LEXICON_GZIP_PATH = LEXICON_PATH.with_name(LEXICON_PATH.name + ".gz")
+LEXICON_COLUMNS = ["word", "top", "gender", "part_of_speech", "frequency"]
+
+LexiconRecord = Tuple[str, bool, Optional[str], Optional[str], float]
 
-def setup_db_engine(db_user: str, db_password: str, db_host: str, db_port: int, db_name: str):
-    global engine, async_session
+
+def create_db_engine(db_config: DBConfig) -> AsyncEngine:
     db_url = "postgresql+asyncpg://{}:{}@{}:{}/{}".format(
-        db_user, db_password, db_host, db_port, db_name,
+        db_config.user, db_config.password, db_config.host, db_config.port, db_config.db,
     )
-    engine = AsyncEngine(create_engine(db_url))
-    async_session = sessionmaker(  # type: ignore
-        engine, class_=AsyncSession, expire_on_commit=False,
+    return create_async_engine(
+        db_url,
+        pool_size=db_config.pool_size,
+        max_overflow=db_config.max_overflow,
+        pool_timeout=db_config.pool_timeout,
+        pool_recycle=db_config.pool_recycle,
+        pool_pre_ping=db_config.pool_pre_ping,
+        pool_use_lifo=db_config.pool_use_lifo,
     )
 
 
-async def create_db_and_tables():
-    if engine is None:
-        raise Exception("Database engine is not initialized")
+def create_session_maker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def _create_missing_indexes(connection: Connection):
+    # create_all() skips existing tables, so indexes added later are created here
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _open_lexicon(path: Path) -> TextIO:
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", newline="")
+    return open(path, newline="")
+
+
+def _read_lexicon_records(path: Path) -> Generator[LexiconRecord, None, None]:
+    with _open_lexicon(path) as f:
+        for parts in csv.reader(f, delimiter=";", quoting=csv.QUOTE_NONE):
+            if not parts:
+                continue
+            yield (
+                parts[1],
+                parts[3] == "1",
+                parts[5] if parts[5] else None,
+                parts[4] if parts[4] else None,
+                float(parts[2]),
+            )
+
+
+async def create_db_and_tables(engine: AsyncEngine):
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
-    async with get_session() as session:
-        query = select(Lexicon).limit(1)
-        if (await session.exec(query)).first() is None:
-            with open(Path(__file__).parent.parent / "data/full_words.csv") as f:
-                async with engine.begin() as conn:
-                    for line in f:
-                        line = line.strip()
-                        parts = line.split(";")
-                        await conn.execute(
-                            text(
-                                "INSERT INTO lexicon "
-                                "(word, top, gender, part_of_speech, frequency) "
-                                "VALUES (:word, :top, :gender, :part_of_speech, :frequency)",
-                            ),
-                            {
-                                "word": parts[1],
-                                "top": parts[3] == "1",
-                                "gender": parts[5] if parts[5] else None,
-                                "part_of_speech": parts[4] if parts[4] else None,
-                                "frequency": float(parts[2]),
-                            },
-                        )
-                    await conn.commit()
-            await session.commit()
-
-
-async def _get_session() -> AsyncGenerator[AsyncSession, None]:
-    if async_session is None:
-        raise Exception("Database engine is not initialized")
-
-    async with async_session() as session:
-        yield session
-
-
-@asynccontextmanager
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    if async_session is None:
-        raise Exception("Database engine is not initialized")
-    async with async_session() as session:
-        yield session
-
-
-SessionDep = Annotated[AsyncSession, Depends(_get_session)]
+        await conn.run_sync(_create_missing_indexes)
+        query = select(Lexicon.id).limit(1)
+        lexicon_empty = (await conn.execute(query)).first() is None
+    if lexicon_empty:
+        lexicon_path = LEXICON_GZIP_PATH if LEXICON_GZIP_PATH.exists() else LEXICON_PATH
+        log.info("Loading lexicon from {}".format(lexicon_path))
+        async with engine.begin() as conn:
+            raw_connection = await conn.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                "lexicon",
+                records=_read_lexicon_records(lexicon_path),
+                columns=LEXICON_COLUMNS,
+            )
+
+
+# Request-scoped session, provided by DBProvider in klang.di
+SessionDep = FromDishka[AsyncSession]
@@ -1,12 +1,18 @@
 from typing import AsyncGenerator
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector, ClientTimeout
 from dishka import Provider, provide, Scope, make_async_container, AsyncContainer
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from klang.config import Config
+from klang.db import create_db_engine, create_session_maker
 from klang.llm import LLMClient
 from klang.storage import Storage
 
+# Also covers Narakeet MP3 downloads, not only the OAuth provider calls
+HTTP_CLIENT_TIMEOUT_SECONDS = 30
+
 
 class ConfigProvider(Provider):
     def __init__(self, config: Config):
@@ -18,10 +24,38 @@ class ConfigProvider(Provider):
         return self.config
 
 
+class DBProvider(Provider):
+    @provide(scope=Scope.RUNTIME)
+    async def new_engine(self, config: Config) -> AsyncGenerator[AsyncEngine, None]:
+        engine = create_db_engine(config.db)
+        yield engine
+        await engine.dispose()
+
+    @provide(scope=Scope.RUNTIME)
+    def new_session_maker(self, engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+        return create_session_maker(engine)
+
+    @provide(scope=Scope.REQUEST)
+    async def new_session(
+        self, session_maker: async_sessionmaker[AsyncSession],
+    ) -> AsyncGenerator[AsyncSession, None]:
+        async with session_maker() as session:
+            yield session
+
+
 class HTTPClientProvider(Provider):
     @provide(scope=Scope.RUNTIME)
     async def new_client(self) -> AsyncGenerator[ClientSession, None]:
-        async with ClientSession() as session:
+        connector = TCPConnector(
+            limit=100,
+            limit_per_host=32,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
+        async with ClientSession(
+            connector=connector, timeout=ClientTimeout(total=HTTP_CLIENT_TIMEOUT_SECONDS),
+        ) as session:
             yield session
 
 
@@ -33,14 +67,20 @@ class StorageProvider(Provider):
 
 class LLMProvider(Provider):
     @provide(scope=Scope.RUNTIME)
-    async def new_llm(self, config: Config) -> AsyncGenerator[LLMClient, None]:
-        async with LLMClient(config) as llm:
+    async def new_llm(
+        self,
+        config: Config,
+        http_client: ClientSession,
+        session_maker: async_sessionmaker[AsyncSession],
+    ) -> AsyncGenerator[LLMClient, None]:
+        async with LLMClient(config, http_client, session_maker) as llm:
             yield llm
 
 
 def make_di_container(config: Config) -> AsyncContainer:
     return make_async_container(
         ConfigProvider(config),
+        DBProvider(),
         HTTPClientProvider(),
         StorageProvider(),
         LLMProvider(),
@@ -1,7 +1,11 @@
+import heapq
+import math
+import random
 from enum import Enum
-from typing import Type, TypeVar, Dict
+from typing import Type, TypeVar, Dict, Sequence, List, Optional
 
 TEnum = TypeVar("TEnum", bound=Enum)
+T = TypeVar("T")
 
 
 def clamp(number: float, min_value: float, max_value: float) -> float:
@@ -10,10 +14,21 @@ def clamp(number: float, min_value: float, max_value: float) -> float:
 
 def next_enum_map(enum_class: Type[TEnum]) -> Dict[TEnum, TEnum]:
     variants = list(enum_class)
-    result = {}
-    for i, variant in enumerate(variants):
-        if i == len(variants) - 1:
-            break
-        result[variant] = variants[i + 1]
+    return dict(zip(variants, variants[1:]))
 
-    return result
+
+def weighted_sample(
+    population: Sequence[T],
+    weights: Sequence[float],
+    k: int,
+    rng: Optional[random.Random] = None,
+) -> List[T]:
+    uniform = rng.random if rng is not None else random.random
+    # Efraimidis-Spirakis: top k of u ** (1 / w), compared as logs. Without replacement,
+    # zero weights are picked uniformly, only after all positive ones
+    keys = (
+        (weight > 0, math.log(1.0 - uniform()) / (weight if weight > 0 else 1.0))
+        for weight in weights
+    )
+    top = heapq.nlargest(k, zip(keys, range(len(population))))
+    return [population[i] for _, i in top]
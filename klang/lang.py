@@ -1,20 +1,17 @@
 from klang.models import WordMeaning
 
+NOUN_ARTICLES = {"male": "der ", "female": "die ", "neutral": "das "}
+
 
 def make_full_word(meaning: WordMeaning) -> str:
     if meaning.part_of_speech == "noun":
         if meaning.gender is None:
-            raise ValueError("No gender for noun {} {}".format(meaning.word, meaning.id))
-        else:
-            if meaning.gender == "male":
-                return "der " + meaning.word
-            elif meaning.gender == "female":
-                return "die " + meaning.word
-            elif meaning.gender == "neutral":
-                return "das " + meaning.word
-            else:
-                raise ValueError("Unknown gender {} for noun {} {}".format(
-                    meaning.gender, meaning.word, meaning.id,
-                ))
+            raise ValueError(f"No gender for noun {meaning.word} {meaning.id}")
+        article = NOUN_ARTICLES.get(meaning.gender)
+        if article is None:
+            raise ValueError(
+                f"Unknown gender {meaning.gender} for noun {meaning.word} {meaning.id}",
+            )
+        return article + meaning.word
     else:
         return meaning.word
@@ -1,31 +1,46 @@
 import asyncio
 import base64
-import concurrent.futures
 import logging
 import random
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import List, Optional, Dict, TypeVar, Generic
+from typing import List, Optional, Dict, TypeVar, Generic, Sequence, Union
 
 import aiofiles
 import yarl
 from aiohttp import ClientSession
 from openai import AsyncOpenAI, RateLimitError
 from pydantic import BaseModel
-from sqlalchemy import Select
+from sqlalchemy import Select, bindparam
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from klang.config import Config
-from klang.db import get_session
 from klang.models import WordMeaning, WordMeaningTranslation, LLMLog
 
 log = logging.getLogger(__name__)
 
 NARAKEET_URL = f'https://api.narakeet.com/text-to-speech/mp3'
 NARAKEET_VOICES = ["Andreas", "Klara"]
+NARAKEET_URLS = [
+    str(yarl.URL(NARAKEET_URL).with_query({"voice": voice, "voice-speed": "0.9"}))
+    for voice in NARAKEET_VOICES
+]
+
+# Statements are built once and bound with params per call.
+# Selecting the indexed column itself lets Postgres answer with an index-only scan
+MEANING_EXISTS_QUERY: Select = select(WordMeaning.word).where(
+    WordMeaning.word == bindparam("word"),
+).limit(1)
+MEANINGS_BY_WORD_QUERY: Select = select(WordMeaning).where(WordMeaning.word == bindparam("word"))
+# Uses the (word_meaning_id, language) unique index, only the en row is loaded
+EN_TRANSLATION_QUERY: Select = select(WordMeaningTranslation).where(
+    WordMeaningTranslation.word_meaning_id == bindparam("word_meaning_id"),
+    WordMeaningTranslation.language == "en",
+)
 
 T = TypeVar("T")
 S = TypeVar("S")
@@ -64,7 +79,8 @@ class LLMWord(BaseModel):
 
 @dataclass
 class TaskEventContainer:
-    event: asyncio.Event
+    # Shared by all waiters of the same key, resolved once by the worker
+    future: asyncio.Future
     exception: Optional[Exception] = None
 
 
@@ -89,9 +105,13 @@ class WordSoundTask:
     mp3_path: Path
 
 
+AnyTask = Union[WordMeaningTask, WordIllustrationTask, WordSoundTask]
+
+
 @dataclass
 class TaskContainer(Generic[T, S]):
-    lock: asyncio.Lock
+    # Accessed only from the event loop without awaits between lookup and insert,
+    # so no lock is needed to deduplicate tasks
     events: Dict[S, TaskEventContainer]
     queue: asyncio.Queue[T]
 
@@ -111,59 +131,105 @@ class TaskContainerWordSound(TaskContainer[WordSoundTask, str]):
     pass
 
 
-def _save_img_sync(png_path: Path, b64_json: str):
-    with open(png_path, "wb") as f:
-        f.write(base64.b64decode(b64_json))
+async def _get_task_batch(queue: asyncio.Queue[T], max_size: int) -> List[T]:
+    tasks = [await queue.get()]
+    while len(tasks) < max_size:
+        try:
+            tasks.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return tasks
+
+
+async def _commit_tasks(session: AsyncSession, tasks: Sequence[AnyTask], kind: str):
+    # Nothing a failed task added to the session is persisted. Meaning and illustration
+    # tasks are committed one by one, and a sound task adds its row only after success,
+    # so a batch is committed only when some of its tasks succeeded
+    try:
+        if all(task.event_container.exception is not None for task in tasks):
+            await session.rollback()
+        else:
+            await session.commit()
+    except OperationalError as e:
+        log.error("DB operational error ({}) {}".format(kind, e))
+        commit_error: Optional[Exception] = e
+    except Exception as e:
+        log.exception(f"Error committing word {kind} tasks: {e}")
+        commit_error = e
+    else:
+        commit_error = None
+    for task in tasks:
+        future = task.event_container.future
+        if future.done():
+            continue
+        exception = task.event_container.exception or commit_error
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(None)
+
+
+async def _wait_task(container: TaskContainer[T, S], key: S, event_container: TaskEventContainer):
+    try:
+        # Shielded, so a cancelled waiter does not cancel the future for the others
+        await asyncio.shield(event_container.future)
+    finally:
+        if event_container.future.done() and container.events.get(key) is event_container:
+            del container.events[key]
 
 
 class LLMClient:
     SYSTEM_CONTEXT = "You are generating a content for a high quality word learning website."
 
-    def __init__(self, config: Config):
+    def __init__(
+        self,
+        config: Config,
+        http_client: ClientSession,
+        session_maker: async_sessionmaker[AsyncSession],
+    ):
         self.config = config
+        self.http_client = http_client
+        self.session_maker = session_maker
 
         self.openai = AsyncOpenAI(api_key=config.openai_key)
-        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=10)
+        self._narakeet_headers = {
+            "Accept": "application/octet-stream",
+            "Content-Type": "text/plain",
+            "x-api-key": config.narakeet_key,
+        }
 
         self._word_meaning_tasks = TaskContainerWordMeaning(
-            lock=asyncio.Lock(), events={}, queue=asyncio.Queue[WordMeaningTask](1000),
+            events={}, queue=asyncio.Queue[WordMeaningTask](1000),
         )
-        self._word_meaning_job: Optional[asyncio.Task] = None
         self._word_illustration_tasks = TaskContainerWordIllustration(
-            lock=asyncio.Lock(), events={}, queue=asyncio.Queue[WordIllustrationTask](1000),
+            events={}, queue=asyncio.Queue[WordIllustrationTask](1000),
         )
-        self._word_illustration_job: Optional[asyncio.Task] = None
         self._word_sound_tasks = TaskContainerWordSound(
-            lock=asyncio.Lock(), events={}, queue=asyncio.Queue[WordSoundTask](1000),
+            events={}, queue=asyncio.Queue[WordSoundTask](1000),
         )
-        self._word_sound_job: Optional[asyncio.Task] = None
+        self._jobs: List[asyncio.Task] = []
+
+        # Shared by all workers to cap in-flight requests per upstream API
+        self._openai_semaphore = asyncio.Semaphore(config.llm.openai_concurrency)
+        self._narakeet_semaphore = asyncio.Semaphore(config.llm.narakeet_concurrency)
 
     async def start(self):
         log.info("Starting LLM client background tasks")
-        if self._word_meaning_job is not None:
+        if self._jobs:
             raise RuntimeError("Already running")
-        if self._word_illustration_job is not None:
-            raise RuntimeError("Already running")
-        if self._word_sound_job is not None:
-            raise RuntimeError("Already running")
-        self._word_meaning_job = asyncio.create_task(
-            self._process_word_meanings_forever(),
-        )
-        self._word_illustration_job = asyncio.create_task(
-            self._process_word_illustrations_forever(),
-        )
-        self._word_sound_job = asyncio.create_task(
-            self._process_word_sounds_forever(),
-        )
+        llm_config = self.config.llm
+        for _ in range(llm_config.meaning_workers):
+            self._jobs.append(asyncio.create_task(self._process_word_meanings_forever()))
+        for _ in range(llm_config.illustration_workers):
+            self._jobs.append(asyncio.create_task(self._process_word_illustrations_forever()))
+        for _ in range(llm_config.sound_workers):
+            self._jobs.append(asyncio.create_task(self._process_word_sounds_forever()))
 
     async def stop(self):
         log.info("Stopping LLM client background tasks")
-        if self._word_meaning_job is not None:
-            self._word_meaning_job.cancel()
-        if self._word_illustration_job is not None:
-            self._word_illustration_job.cancel()
-        if self._word_sound_job is not None:
-            self._word_sound_job.cancel()
+        for job in self._jobs:
+            job.cancel()
+        self._jobs.clear()
 
     async def __aenter__(self):
         await self.start()
@@ -183,20 +249,20 @@ class LLMClient:
     async def _process_word_meanings(self):
         log.info("Starting word meaning processing")
         while True:
+            # One task per get, so each waiter is resolved as soon as its own word is
+            # committed and idle workers can pick up the next queued word
             task = await self._word_meaning_tasks.queue.get()
             log.info(f"Processing task for word meanings of '{task.word}'")
-            async with get_session() as session:
+            async with self.session_maker() as session:
                 try:
                     await self._generate_word_meanings(session, task.word)
-                    task.event_container.event.set()
                 except OperationalError as e:
                     log.error("DB operational error (meaning) {}".format(e))
                     task.event_container.exception = e
-                    task.event_container.event.set()
                 except Exception as e:
                     log.exception(f"Error processing word meaning of '{task.word}': {e}")
                     task.event_container.exception = e
-                    task.event_container.event.set()
+                await _commit_tasks(session, [task], "meaning")
 
     async def _process_word_illustrations_forever(self):
         while True:
@@ -211,20 +277,15 @@ class LLMClient:
         while True:
             task = await self._word_illustration_tasks.queue.get()
             log.info(f"Processing task for word illustration of '{task.word}'")
-            async with get_session() as session:
+            async with self.session_maker() as session:
                 try:
                     await self._generate_word_illustration(
                         session, task.word, task.description, task.png_path,
                     )
-                    task.event_container.event.set()
-                except OperationalError as e:
-                    log.error("DB operational error (illustration) {}".format(e))
-                    task.event_container.exception = e
-                    task.event_container.event.set()
                 except Exception as e:
                     log.exception(f"Error processing word illustration: {e}")
                     task.event_container.exception = e
-                    task.event_container.event.set()
+                await _commit_tasks(session, [task], "illustration")
 
     async def _process_word_sounds_forever(self):
         while True:
@@ -237,25 +298,26 @@ class LLMClient:
     async def _process_word_sounds(self):
         log.info("Starting word sounds processing")
         while True:
-            task = await self._word_sound_tasks.queue.get()
-            log.info(f"Processing task for word sound of '{task.word}'")
-            async with (
-                get_session() as session,
-                ClientSession() as http_client,
-            ):
-                try:
-                    await self._generate_word_sound(
-                        session, http_client, task.word, task.mp3_path,
-                    )
-                    task.event_container.event.set()
-                except OperationalError as e:
-                    log.error("DB operational error (sound) {}".format(e))
-                    task.event_container.exception = e
-                    task.event_container.event.set()
-                except Exception as e:
-                    log.exception(f"Error processing word sound: {e}")
-                    task.event_container.exception = e
-                    task.event_container.event.set()
+            tasks = await _get_task_batch(
+                self._word_sound_tasks.queue, self.config.llm.batch_size,
+            )
+            log.info("Processing tasks for word sounds of {}".format(
+                ", ".join(f"'{task.word}'" for task in tasks),
+            ))
+            async with self.session_maker() as session:
+                # Narakeet requests are independent, so the batch is fetched concurrently
+                results = await asyncio.gather(
+                    *(
+                        self._generate_word_sound(session, task.word, task.mp3_path)
+                        for task in tasks
+                    ),
+                    return_exceptions=True,
+                )
+                for task, result in zip(tasks, results):
+                    if isinstance(result, Exception):
+                        log.error(f"Error processing word sound: {result}", exc_info=result)
+                        task.event_container.exception = result
+                await _commit_tasks(session, tasks, "sound")
 
     def _make_messages_with_context(self, request: str) -> List[Dict[str, str]]:
         return [
@@ -266,25 +328,22 @@ class LLMClient:
     async def wait_word_meanings(
         self, session: AsyncSession, word: str,
     ) -> List[WordMeaning]:
-        sql_query: Select = select(WordMeaning).where(WordMeaning.word == word)
-        result = list((await session.exec(sql_query)).all())
-        if len(result) > 0:
-            return result
-
-        async with self._word_meaning_tasks.lock:
+        # Callers usually come here on a miss, so only check for any row before queueing
+        query_params = {"word": word}
+        if (await session.exec(MEANING_EXISTS_QUERY, params=query_params)).first() is None:
             event_container = self._word_meaning_tasks.events.get(word)
             if event_container is None:
-                event_container = TaskEventContainer(event=asyncio.Event())
+                event_container = TaskEventContainer(
+                    future=asyncio.get_running_loop().create_future(),
+                )
                 task = WordMeaningTask(event_container=event_container, word=word)
                 self._word_meaning_tasks.events[word] = event_container
                 log.info(f"Queueing task for word meanings of '{word}'")
                 self._word_meaning_tasks.queue.put_nowait(task)
 
-        await event_container.event.wait()
-        if event_container.exception is not None:
-            raise event_container.exception
-        sql_query = select(WordMeaning).where(WordMeaning.word == word)
-        result = list((await session.exec(sql_query)).all())
+            await _wait_task(self._word_meaning_tasks, word, event_container)
+
+        result = list((await session.exec(MEANINGS_BY_WORD_QUERY, params=query_params)).all())
         if len(result) == 0:
             raise RuntimeError(f"LLM task complete, but no results found for meanings of '{word}'")
         return result
@@ -295,39 +354,31 @@ class LLMClient:
         if png_path.exists():
             return
 
-        query: Select = select(WordMeaning).where(WordMeaning.id == word_meaning_id)
-        word_meaning: WordMeaning = (await session.exec(query)).first()
-        if word_meaning is None:
-            raise RuntimeError(f"Word meaning with id {word_meaning_id} not found")
-
-        for word_translation in word_meaning.translations:
-            if word_translation.language == "en":
-                translated_word = word_translation.translation
-                translated_description = word_translation.description
-                break
-        else:
+        query_params = {"word_meaning_id": word_meaning_id}
+        word_translation: Optional[WordMeaningTranslation] = (
+            await session.exec(EN_TRANSLATION_QUERY, params=query_params)
+        ).first()
+        if word_translation is None:
             raise RuntimeError(f"No en translation for word meaning with id {word_meaning_id}")
+        translated_word = word_translation.translation
+        translated_description = word_translation.description
 
-        if png_path.exists():
-            return
-
-        async with self._word_illustration_tasks.lock:
-            event_container = self._word_illustration_tasks.events.get(word_meaning_id)
-            if event_container is None:
-                event_container = TaskEventContainer(event=asyncio.Event())
-                task = WordIllustrationTask(
-                    event_container=event_container,
-                    word=translated_word,
-                    description=translated_description,
-                    png_path=png_path,
-                )
-                self._word_illustration_tasks.events[word_meaning_id] = event_container
-                log.info(f"Queueing task for word illustration of '{translated_word}'")
-                self._word_illustration_tasks.queue.put_nowait(task)
+        event_container = self._word_illustration_tasks.events.get(word_meaning_id)
+        if event_container is None:
+            event_container = TaskEventContainer(
+                future=asyncio.get_running_loop().create_future(),
+            )
+            task = WordIllustrationTask(
+                event_container=event_container,
+                word=translated_word,
+                description=translated_description,
+                png_path=png_path,
+            )
+            self._word_illustration_tasks.events[word_meaning_id] = event_container
+            log.info(f"Queueing task for word illustration of '{translated_word}'")
+            self._word_illustration_tasks.queue.put_nowait(task)
 
-        await event_container.event.wait()
-        if event_container.exception is not None:
-            raise event_container.exception
+        await _wait_task(self._word_illustration_tasks, word_meaning_id, event_container)
         if not png_path.exists():
             raise RuntimeError(
                 f"LLM task complete, but no illustration found for meaning id {word_meaning_id}",
@@ -339,40 +390,41 @@ class LLMClient:
         if mp3_path.exists():
             return
 
-        async with self._word_sound_tasks.lock:
-            event_container = self._word_sound_tasks.events.get(word)
-            if event_container is None:
-                event_container = TaskEventContainer(event=asyncio.Event())
-                task = WordSoundTask(event_container=event_container, word=word, mp3_path=mp3_path)
-                self._word_sound_tasks.events[word] = event_container
-                log.info(f"Queueing task for word sound of '{word}'")
-                self._word_sound_tasks.queue.put_nowait(task)
+        event_container = self._word_sound_tasks.events.get(word)
+        if event_container is None:
+            event_container = TaskEventContainer(
+                future=asyncio.get_running_loop().create_future(),
+            )
+            task = WordSoundTask(event_container=event_container, word=word, mp3_path=mp3_path)
+            self._word_sound_tasks.events[word] = event_container
+            log.info(f"Queueing task for word sound of '{word}'")
+            self._word_sound_tasks.queue.put_nowait(task)
 
-        await event_container.event.wait()
-        if event_container.exception is not None:
-            raise event_container.exception
+        await _wait_task(self._word_sound_tasks, word, event_container)
 
         if not mp3_path.exists():
             raise RuntimeError(f"LLM task complete, but no results found for sound of '{word}'")
 
     async def _generate_word_meanings(self, session: AsyncSession, word: str):
-        sql_query: Select = select(WordMeaning).where(WordMeaning.word == word)
-        result = (await session.exec(sql_query)).all()
-        if len(result) > 0:
+        # A waiter can queue the word again after the first task was committed and its
+        # dedup entry removed, so the worker re-checks before calling the LLM
+        exists = (await session.exec(MEANING_EXISTS_QUERY, params={"word": word})).first()
+        if exists is not None:
             log.info(f"Word meanings for '{word}' already exist")
             return
         while True:
             try:
-                completion = await self.openai.beta.chat.completions.parse(
-                    model="gpt-4o",
-                    messages=self._make_messages_with_context(
-                        "Translation of a german word \"{}\" to russian and english, "
-                        "with description, maximum 3 most popular meanings, "
-                        "avoid duplicates and close synonyms.".format(word)
-                    ),
-                    response_format=LLMWord,
-                    n=1,
-                )
+                async with self._openai_semaphore:
+                    completion = await self.openai.beta.chat.completions.parse(
+                        model="gpt-4o",
+                        messages=self._make_messages_with_context(
+                            f"Translation of a german word \"{word}\" to russian and english, "
+                            "with description, maximum 3 most popular meanings, "
+                            "avoid duplicates and close synonyms."
+                        ),
+                        response_format=LLMWord,
+                        n=1,
+                    )
                 break
             except RateLimitError as err:
                 log.warning(f"LLM rate limit exceeded: {err}, retrying in 10 seconds...")
@@ -407,7 +459,6 @@ class LLMClient:
                 description=llm_meaning.russian_translation.description,
             ))
             session.add(meaning)
-        await session.commit()
         log.info(f"LLM-generated word meanings for {word}")
 
     async def _generate_word_illustration(
@@ -418,29 +469,27 @@ class LLMClient:
             return
         while True:
             try:
-                result = await self.openai.images.generate(
-                    model="dall-e-3",
-                    prompt=(
-                        "Draw illustration to concept \"{}. {}\" "
-                        "without any words on a picture, just the illustration "
-                        "with a relatively simple and straightforward style".format(
-                            word, description,
-                        )
-                    ),
-                    size="1024x1024",
-                    quality="standard",
-                    response_format="b64_json",
-                    n=1,
-                )
+                async with self._openai_semaphore:
+                    result = await self.openai.images.generate(
+                        model="dall-e-3",
+                        prompt=(
+                            f"Draw illustration to concept \"{word}. {description}\" "
+                            "without any words on a picture, just the illustration "
+                            "with a relatively simple and straightforward style"
+                        ),
+                        size="1024x1024",
+                        quality="standard",
+                        response_format="b64_json",
+                        n=1,
+                    )
                 break
             except RateLimitError as err:
                 log.warning(f"LLM rate limit exceeded: {err}, retrying in 10 seconds...")
                 await asyncio.sleep(10)
 
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            self.executor, _save_img_sync, png_path, result.data[0].b64_json,
-        )
+        image = base64.b64decode(result.data[0].b64_json)
+        async with aiofiles.open(png_path, "wb") as f:
+            await f.write(image)
 
         session.add(LLMLog(
             request_type="translation",
@@ -449,28 +498,14 @@ class LLMClient:
             amount_in=0,
             amount_out=1024,
         ))
-        await session.commit()
         log.info(f"LLM-generated word illustration for '{description}'")
 
-    async def _generate_word_sound(
-        self, session: AsyncSession, http_client: ClientSession, word: str, mp3_path: Path,
-    ):
+    async def _generate_word_sound(self, session: AsyncSession, word: str, mp3_path: Path):
         if mp3_path.exists():
             log.info(f"Word sound '{mp3_path.name}' already exists")
             return
-        voice = random.choice(NARAKEET_VOICES)
-        url = yarl.URL(NARAKEET_URL).with_query({
-            "voice": voice,
-            "voice-speed": "0.9",
-        })
-        async with http_client.post(
-            str(url),
-            data=word,
-            headers={
-                "Accept": "application/octet-stream",
-                "Content-Type": "text/plain",
-                'x-api-key': self.config.narakeet_key,
-            },
+        async with self._narakeet_semaphore, self.http_client.post(
+            random.choice(NARAKEET_URLS), data=word, headers=self._narakeet_headers,
         ) as response:
             response.raise_for_status()
             duration_seconds = response.headers.get("x-duration-seconds")
@@ -480,11 +515,9 @@ class LLMClient:
                 duration_seconds_parsed = 0
                 log.error(f"Wrong duration seconds header '{duration_seconds}' for word '{word}'")
             async with aiofiles.open(mp3_path, "wb") as f:
-                while True:
-                    data = await response.content.read(1024 * 64)
-                    if len(data) == 0:
-                        break
-                    await f.write(data)
+                # Hands over aiohttp's buffered chunks as they are, without re-slicing
+                async for chunk in response.content.iter_any():
+                    await f.write(chunk)
 
         session.add(LLMLog(
             request_type="sound",
@@ -493,5 +526,4 @@ class LLMClient:
             amount_in=0,
             amount_out=duration_seconds_parsed,
         ))
-        await session.commit()
         log.info(f"LLM-generated word sound for '{word}'")
@@ -6,7 +6,6 @@ from dishka.integrations.fastapi import setup_dishka
 
 from klang.app import create_app
 from klang.config import load_config
-from klang.db import setup_db_engine
 from klang.di import make_di_container
 from klang.logs import setup_logging
 
@@ -22,14 +21,6 @@ def main():
     config = load_config(args.config)
     container = make_di_container(config)
 
-    setup_db_engine(
-        db_user=config.db.user,
-        db_password=config.db.password,
-        db_host=config.db.host,
-        db_port=config.db.port,
-        db_name=config.db.db,
-    )
-
     host = args.host if args.host is not None else config.listen_host
     port = args.port if args.port is not None else config.listen_port
     app = create_app(config)
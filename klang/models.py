@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from sqlalchemy import text
-from sqlmodel import SQLModel, Field, Relationship, UniqueConstraint
+from sqlmodel import SQLModel, Field, Relationship, UniqueConstraint, Index
 
 
 class UserSettingsValue(SQLModel, table=True):
@@ -12,6 +12,11 @@ class UserSettingsValue(SQLModel, table=True):
 
 
 class Lexicon(SQLModel, table=True):
+    # Makes "word LIKE 'prefix%'" index-seekable regardless of database collation
+    __table_args__ = (
+        Index("ix_lexicon_word_pattern", "word", postgresql_ops={"word": "text_pattern_ops"}),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     word: str = Field(index=True, unique=True)
     top: bool = Field(index=True)
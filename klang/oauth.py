@@ -1,20 +1,22 @@
 import base64
+import json
 import secrets
-import string
+import time
 from datetime import datetime, timedelta
 from hashlib import sha256
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Dict
+from urllib.parse import urlencode, quote
 
 import aiohttp
-import yarl
 from aiohttp import ClientSession
+from cachetools import TLRUCache
 from fastapi import HTTPException
 from pydantic import BaseModel
 
 from klang.config import Config
 
-SECURE_ALPHABET = string.ascii_letters + string.digits + "!#$%*+,-.:;<=>?@^_|~"
 OAUTH_SESSION_LIFETIME = timedelta(minutes=30)
+USER_CACHE_TTL_SECONDS = 60
 
 
 class OAuthError(Exception):
@@ -28,20 +30,23 @@ class OAuthTokenResponse(BaseModel):
     expires: str | None
 
 
-def random_secure_string(n_symbols=64):
-    return ''.join(secrets.choice(SECURE_ALPHABET) for _ in range(n_symbols))
-
-
 def verifier_to_challenge_s256(verifier: str) -> str:
     return base64.urlsafe_b64encode(
         sha256(verifier.encode("utf-8")).digest(),
     ).decode("utf-8").rstrip("=")
 
 
+def _url_with_query(url: str, query: Dict[str, str]) -> str:
+    # Plain string building, the configured base URLs need no parsing per request
+    return url + ("&" if "?" in url else "?") + urlencode(query, quote_via=quote)
+
+
 def make_auth_url(config: Config) -> Tuple[str, str, str]:
-    verifier = random_secure_string()
-    state = random_secure_string()
-    return str(yarl.URL(config.oauth_client.auth_uri).with_query(
+    # 48 bytes give a 64 characters verifier from the RFC 7636 unreserved alphabet
+    verifier = secrets.token_urlsafe(48)
+    state = secrets.token_urlsafe(32)
+    return _url_with_query(
+        config.oauth_client.auth_uri,
         {
             "client_id": config.oauth_client.client_id,
             "redirect_uri": config.oauth_client.callback_uri,
@@ -50,17 +55,15 @@ def make_auth_url(config: Config) -> Tuple[str, str, str]:
             "code_challenge": verifier_to_challenge_s256(verifier),
             "code_challenge_method": "S256",
         },
-    )), verifier, state
+    ), verifier, state
 
 def make_logout_url(
     config: Config, cancel_uri: str, redirect_uri: str,
 ) -> str:
-    url = yarl.URL(config.oauth_client.logout_uri)
-    url = url.with_query({
+    return _url_with_query(config.oauth_client.logout_uri, {
         "redirect_uri": redirect_uri,
         "cancel_uri": cancel_uri,
     })
-    return str(url)
 
 
 def oauth_verifier_cookie_name() -> str:
@@ -125,7 +128,41 @@ class OAuthUser(BaseModel):
     username: Optional[str] = None
 
 
+# Value is the user and its cache lifetime in seconds
+_CachedUser = Tuple[OAuthUser, float]
+
+# Keyed by token digest, so raw tokens are never kept in memory
+_user_cache: TLRUCache[bytes, _CachedUser] = TLRUCache(
+    maxsize=10_000, ttu=lambda _key, value, now: now + value[1],
+)
+
+
+def _token_cache_ttl(token: str) -> float:
+    # The signature is not checked, exp only shortens the lifetime of a cached user
+    parts = token.split(".")
+    if len(parts) != 3:
+        return USER_CACHE_TTL_SECONDS
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+        expires_in = float(payload["exp"]) - time.time()
+    except (ValueError, KeyError, TypeError):
+        return USER_CACHE_TTL_SECONDS
+    return max(min(expires_in, USER_CACHE_TTL_SECONDS), 0)
+
+
 async def token_to_user(http_client: ClientSession, config: Config, token: str) -> OAuthUser:
+    cache_key = sha256(token.encode("utf-8")).digest()
+    cached = _user_cache.get(cache_key)
+    if cached is not None:
+        return cached[0]
+    user = await _fetch_user(http_client, config, token)
+    ttl = _token_cache_ttl(token)
+    if ttl > 0:
+        _user_cache[cache_key] = (user, ttl)
+    return user
+
+
+async def _fetch_user(http_client: ClientSession, config: Config, token: str) -> OAuthUser:
     async with http_client.get(
         config.oauth_client.userinfo_uri,
         headers={"Authorization": f"Bearer {token}"},
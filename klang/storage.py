@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 from klang.config import Config
@@ -8,15 +9,18 @@ class Storage:
         self.config = config
         self.config.illustrations_dir.mkdir(parents=True, exist_ok=True)
         self.config.sounds_dir.mkdir(parents=True, exist_ok=True)
+        # Joined as strings, so a path needs one Path parse instead of a join of two
+        self._illustrations_prefix = os.fspath(self.config.illustrations_dir) + os.sep
+        self._sounds_prefix = os.fspath(self.config.sounds_dir) + os.sep
 
     def get_illustrations_dir(self) -> Path:
         return self.config.illustrations_dir
 
     def get_illustration_path(self, word_meaning_id: int) -> Path:
-        return self.config.illustrations_dir / f"{word_meaning_id}.png"
+        return Path(f"{self._illustrations_prefix}{word_meaning_id}.png")
 
     def get_sounds_dir(self) -> Path:
         return self.config.sounds_dir
 
     def get_sound_path(self, word: str) -> Path:
-        return self.config.sounds_dir / f"{word}.mp3"
+        return Path(f"{self._sounds_prefix}{word}.mp3")
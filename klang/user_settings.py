@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 import logging
 from enum import Enum
-from typing import get_type_hints
+from typing import get_type_hints, Callable, Any, Dict, Optional
 
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
@@ -28,6 +28,29 @@ class UserSettings:
     )
 
 
+def _make_converter(key: str, type_hint: Any) -> Optional[Callable[[str], Any]]:
+    if type_hint is int:
+        return int
+    elif type_hint is str:
+        return str
+    elif type_hint is bool:
+        return lambda raw_value: raw_value == "True"
+    elif issubclass(type_hint, Enum):
+        return type_hint
+    else:
+        log.warning(f"Unsupported type hint for setting {key}: {type_hint}")
+        return None
+
+
+# Resolved once at import instead of per load_settings call
+_SETTINGS_TYPES = get_type_hints(UserSettings)
+_SETTINGS_CONVERTERS: Dict[str, Callable[[str], Any]] = {
+    key: converter
+    for key, type_hint in _SETTINGS_TYPES.items()
+    if (converter := _make_converter(key, type_hint)) is not None
+}
+
+
 @dataclass
 class UserSettingEntry:
     key: str
@@ -38,21 +61,10 @@ class UserSettingEntry:
 async def load_settings(session: AsyncSession, user_id: int) -> UserSettings:
     settings = UserSettings()
     query = select(UserSettingsValue).where(UserSettingsValue.user_id == user_id)
-    type_hints = get_type_hints(UserSettings)
     for settings_value in (await session.exec(query)):
         key: str = settings_value.key
-        raw_value: str = settings_value.value
-        if key in type_hints:
-            type_hint = type_hints[key]
-            if type_hint is int:
-                setattr(settings, key, int(raw_value))
-            elif type_hint is str:
-                setattr(settings, key, raw_value)
-            elif type_hint is bool:
-                setattr(settings, key, raw_value == "True")
-            elif issubclass(type_hint, Enum):
-                setattr(settings, key, type_hint(raw_value))
-            else:
-                log.warning(f"Unsupported type hint for setting {key}: {type_hint}")
+        converter = _SETTINGS_CONVERTERS.get(key)
+        if converter is not None:
+            setattr(settings, key, converter(settings_value.value))
 
     return settings
@@ -1,16 +1,47 @@
 import random
 from datetime import datetime
 from enum import Enum
-from typing import Optional, Self, List, Union, Dict, Generator, Literal
+from typing import Optional, Self, List, Union, Dict, Generator, Literal, Any, Collection
 
-from pydantic import BaseModel
-from sqlalchemy import func
-from sqlmodel import select
+import numpy as np
+from pydantic import BaseModel, PrivateAttr
+from sqlalchemy import func, bindparam, Row, and_
+from sqlmodel import select, col
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from klang.api.common import UserData
-from klang.helpers import next_enum_map, clamp
-from klang.models import Vocabulary, Lexicon
+from klang.helpers import next_enum_map, weighted_sample
+from klang.models import Vocabulary, Lexicon, WordMeaning, WordMeaningTranslation
+
+# Training randomness, not security sensitive. One explicit generator for the module,
+# the event loop runs coroutines on one thread so it is never contended
+_rng = random.Random()
+
+# Distractor words loaded per part of speech when a training is created
+DISTRACTOR_POOL_SIZE = 50
+# Vocabulary projected with its meaning and translation, no ORM objects are built
+TRAINING_VOCABULARY_QUERY = select(
+    Vocabulary.id,
+    Vocabulary.word_meaning_id,
+    Vocabulary.learn_count,
+    Vocabulary.last_learned_at,
+    Vocabulary.last_fail_count,
+    WordMeaning.word,
+    WordMeaning.part_of_speech,
+    WordMeaning.gender,
+    WordMeaningTranslation.translation,
+    WordMeaningTranslation.description,
+).join(
+    WordMeaning, Vocabulary.word_meaning_id == WordMeaning.id,
+).join(
+    WordMeaningTranslation,
+    and_(
+        WordMeaningTranslation.word_meaning_id == WordMeaning.id,
+        WordMeaningTranslation.language == bindparam("language"),
+    ),
+).where(Vocabulary.user_id == bindparam("user_id"))
+# Days without learning after which an old word gets the maximum time weight
+MAX_NO_LEARN_DAYS = 90
 
 
 class WordTrainingPhase(Enum):
@@ -45,20 +76,20 @@ class TrainingWord(BaseModel):
     fails: int = 0
 
     @classmethod
-    def from_vocabulary(cls, vocabulary: Vocabulary, language: str) -> Self:
-        translation = vocabulary.word_meaning.get_translation(language)
-        if vocabulary.learn_count > 0:
+    def from_row(cls, row: Row) -> Self:
+        # Row of TRAINING_VOCABULARY_QUERY
+        if row.learn_count > 0:
             phase = WordTrainingPhase.CHOOSE_TRANSLATION
         else:
             phase = WordTrainingPhase.REMEMBER
         return cls(
-            vocabulary_id=vocabulary.id,
-            meaning_id=vocabulary.word_meaning_id,
-            word=vocabulary.word_meaning.word,
-            translation=translation.translation,
-            description=translation.description,
-            part_of_speech=vocabulary.word_meaning.part_of_speech,
-            gender=vocabulary.word_meaning.gender,
+            vocabulary_id=row.id,
+            meaning_id=row.word_meaning_id,
+            word=row.word,
+            translation=row.translation,
+            description=row.description,
+            part_of_speech=row.part_of_speech,
+            gender=row.gender,
             phase=phase,
         )
 
@@ -67,15 +98,37 @@ class WordTraining(BaseModel):
     language: str
     words: Dict[int, TrainingWord]
     user_id: int
+    # Part of speech -> top lexicon words, preprocessed, used as wrong answers
+    distractor_pool: Dict[str, List[str]] = {}
+    # Not serialized, recounted on load and kept up to date by mark_success
+    _remaining: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context: Any):
+        self._remaining = sum(
+            1 for word in self.words.values() if word.phase != WordTrainingPhase.END
+        )
 
     def is_finished(self) -> bool:
-        return all(word.phase == WordTrainingPhase.END for word in self.words.values())
+        return self._remaining == 0
 
     def non_finished_words(self) -> Generator[TrainingWord, None, None]:
         return (word for word in self.words.values() if word.phase != WordTrainingPhase.END)
 
     def non_finished_words_count(self) -> int:
-        return sum(1 for word in self.words.values() if word.phase != WordTrainingPhase.END)
+        return self._remaining
+
+    def mark_success(self, vocabulary_id: int):
+        try:
+            word = self.words[vocabulary_id]
+        except KeyError:
+            raise ValueError(f"Word {vocabulary_id} not found in training")
+        if word.phase == WordTrainingPhase.END:
+            return
+        # The phase and the counter change together, so they cannot drift apart
+        next_phase = NEXT_PHASE_MAP[word.phase]
+        word.phase = next_phase
+        if next_phase == WordTrainingPhase.END:
+            self._remaining -= 1
 
 
 class TaskRemember(BaseModel):
@@ -133,29 +186,60 @@ def preprocess_word(word: str, part_of_speech: str, gender: Optional[str]) -> st
     return word
 
 
-async def get_wrong_words(
-    session: AsyncSession, word: str, part_of_speech: str, count: int,
-) -> List[str]:
-    query = select(Lexicon).where(
-        Lexicon.word != word,
-        Lexicon.part_of_speech == part_of_speech,
+async def load_distractor_pool(
+    session: AsyncSession, parts_of_speech: Collection[str],
+) -> Dict[str, List[str]]:
+    # One query for all parts of speech, random top words ranked within each of them
+    ranked = select(
+        Lexicon.word,
+        Lexicon.gender,
+        Lexicon.part_of_speech,
+        func.row_number().over(
+            partition_by=Lexicon.part_of_speech, order_by=func.random(),
+        ).label("rank"),
+    ).where(
         Lexicon.top == True,
-    ).order_by(func.random()).limit(count)
-    return [
-        preprocess_word(record.word, record.gender, record.part_of_speech)
-        for record in (await session.exec(query)).all()
+        col(Lexicon.part_of_speech).in_(parts_of_speech),
+    ).subquery()
+    query = select(ranked.c.word, ranked.c.gender, ranked.c.part_of_speech).where(
+        ranked.c.rank <= DISTRACTOR_POOL_SIZE,
+    )
+    pool: Dict[str, List[str]] = {part_of_speech: [] for part_of_speech in parts_of_speech}
+    for record in (await session.exec(query)).all():
+        pool[record.part_of_speech].append(
+            preprocess_word(record.word, record.part_of_speech, record.gender),
+        )
+    return pool
+
+
+async def ensure_distractor_pool(session: AsyncSession, training: WordTraining) -> bool:
+    # Trainings saved before the pool was introduced have none, it is loaded once for them.
+    # Returns whether the pool was loaded and the training needs saving
+    if training.distractor_pool or not training.words:
+        return False
+    parts_of_speech = {word.part_of_speech for word in training.words.values()}
+    training.distractor_pool = await load_distractor_pool(session, parts_of_speech)
+    return True
+
+
+def get_wrong_words(
+    training: WordTraining, full_word: str, part_of_speech: str, count: int,
+) -> List[str]:
+    candidates = [
+        word for word in training.distractor_pool.get(part_of_speech, []) if word != full_word
     ]
+    return _rng.sample(candidates, k=min(count, len(candidates)))
 
 
-async def make_task(session: AsyncSession, word: TrainingWord) -> TTask:
+async def make_task(training: WordTraining, word: TrainingWord) -> TTask:
     full_word = preprocess_word(word.word, word.part_of_speech, word.gender)
     if word.phase == WordTrainingPhase.REMEMBER:
         return TaskRemember(word=word, full_word=full_word)
     elif word.phase == WordTrainingPhase.CHOOSE_TRANSLATION:
-        wrong = await get_wrong_words(session, word.word, word.part_of_speech, 3)
+        wrong = get_wrong_words(training, full_word, word.part_of_speech, 3)
         return TaskChooseTranslation(word=word, full_word=full_word, wrong_translations=wrong)
     elif word.phase == WordTrainingPhase.CHOOSE_WORD:
-        wrong = await get_wrong_words(session, word.word, word.part_of_speech, 3)
+        wrong = get_wrong_words(training, full_word, word.part_of_speech, 3)
         return TaskChooseWord(word=word, full_word=full_word, wrong_words=wrong)
     elif word.phase == WordTrainingPhase.WRITE_TRANSLATION:
         return TaskWriteTranslation(word=word, full_word=full_word)
@@ -167,35 +251,36 @@ async def make_task(session: AsyncSession, word: TrainingWord) -> TTask:
         raise ValueError(f"Unknown phase {word.phase}")
 
 
-async def next_task(session: AsyncSession, training: WordTraining) -> TTask:
+async def next_task(training: WordTraining) -> TTask:
     if training.is_finished():
         raise ValueError("Training is already finished")
-    word = random.choice(list(training.non_finished_words()))
-    task = await make_task(session, word)
+    # Reservoir sampling picks a uniform word without copying the words into a list
+    word: Optional[TrainingWord] = None
+    for i, candidate in enumerate(training.non_finished_words()):
+        if _rng.random() * (i + 1) < 1.0:
+            word = candidate
+    task = await make_task(training, word)
     return task
 
 
 async def success_word(vocabulary_id: int, training: WordTraining):
-    try:
-        word = training.words[vocabulary_id]
-    except KeyError:
-        raise ValueError(f"Word {vocabulary_id} not found in training")
-    if word.phase != WordTrainingPhase.END:
-        word.phase = NEXT_PHASE_MAP[word.phase]
+    training.mark_success(vocabulary_id)
 
 
 async def check_finished(session: AsyncSession, training: WordTraining) -> bool:
     if training.is_finished():
+        query = select(Vocabulary).where(
+            col(Vocabulary.id).in_(list(training.words.keys())),
+            Vocabulary.user_id == training.user_id,
+        )
+        vocabularies = {vocabulary.id: vocabulary for vocabulary in (await session.exec(query))}
+        now = datetime.now()
         for word in training.words.values():
-            query = select(Vocabulary).where(
-                Vocabulary.id == word.vocabulary_id,
-                Vocabulary.user_id == training.user_id,
-            )
-            vocabulary = (await session.exec(query)).first()
+            vocabulary = vocabularies.get(word.vocabulary_id)
             if vocabulary is None:
                 raise ValueError(f"Vocabulary record for '{word.word}' not found")
             vocabulary.learn_count += 1
-            vocabulary.last_learned_at = datetime.now()
+            vocabulary.last_learned_at = now
             vocabulary.last_fail_count = word.fails
         await session.commit()
         return True
@@ -221,41 +306,51 @@ async def new_word_training(
     n_new_words = n_words if include_old else n_words - int(n_words / 2)
     n_old_words = n_words - n_new_words
 
+    language = user.settings.source_language.value
+    query_params = {"user_id": user.user.id, "language": language}
+
+    # Load new and old words in one round trip, split by learn count
+    new_words: List[Row] = []
+    old_words: List[Row] = []
+    for row in (await session.exec(TRAINING_VOCABULARY_QUERY, params=query_params)):
+        (old_words if row.learn_count > 0 else new_words).append(row)
+
     # Get new words
-    query = select(Vocabulary).where(
-        Vocabulary.user_id == user.user.id,
-        Vocabulary.learn_count == 0,
-    )
-    new_words = (await session.exec(query)).all()
-    vocabulary_words = random.choices(new_words, k=n_new_words)
+    vocabulary_words = _rng.sample(new_words, k=min(n_new_words, len(new_words)))
 
     # Get old words if needed
     if n_old_words > 0:
-        query = select(Vocabulary).where(
-            Vocabulary.user_id == user.user.id,
-            Vocabulary.learn_count > 0,
+        now = datetime.now()
+        last_learned_at_days_ago = np.array([
+            (now - word.last_learned_at).days
+            if word.last_learned_at is not None else MAX_NO_LEARN_DAYS
+            for word in old_words
+        ], dtype=np.float64)
+        last_fail_counts = np.array(
+            [word.last_fail_count or 0 for word in old_words], dtype=np.float64,
+        )
+        learn_counts = np.array([word.learn_count for word in old_words], dtype=np.float64)
+        # last_learned -> 90 => weight -> 10
+        no_learn_time_weights = (
+            10 * np.clip(last_learned_at_days_ago, 0, MAX_NO_LEARN_DAYS) / MAX_NO_LEARN_DAYS
         )
-        old_words: List[Vocabulary] = (await session.exec(query)).all()
-        weights: List[float] = []
-        for word in old_words:
-            last_learned_at_days_ago = max(0, (datetime.now() - word.learned_at).days)
-            # last_learned -> 90 => weight -> 10
-            no_learn_time_weight = 10 * min(90, last_learned_at_days_ago) / 90
-            last_fail_weight = clamp(word.last_fail_count, 1, 10)
-            learn_count_weight = 10 - clamp(word.learn_count, 0, 9)
-            weights.append(no_learn_time_weight * last_fail_weight * learn_count_weight)
-
-        vocabulary_words += random.choices(old_words, weights=weights, k=n_old_words)
+        last_fail_weights = np.clip(last_fail_counts, 1, 10)
+        learn_count_weights = 10 - np.clip(learn_counts, 0, 9)
+        weights = no_learn_time_weights * last_fail_weights * learn_count_weights
+
+        vocabulary_words += weighted_sample(old_words, weights.tolist(), n_old_words, rng=_rng)
 
     # Shuffle vocabulary words
-    vocabulary_words.shuffle()
+    _rng.shuffle(vocabulary_words)
+
+    # Load distractors for all words at once, tasks then need no queries
+    parts_of_speech = {word.part_of_speech for word in vocabulary_words}
+    distractor_pool = await load_distractor_pool(session, parts_of_speech)
 
     # Create training
     return WordTraining(
-        language=user.settings.source_language.value,
-        words={
-            word.id: TrainingWord.from_vocabulary(word, user.settings.source_language.value)
-            for word in vocabulary_words
-        },
+        language=language,
+        words={word.id: TrainingWord.from_row(word) for word in vocabulary_words},
         user_id=user.user.id,
+        distractor_pool=distractor_pool,
     )
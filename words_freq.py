@@ -1,11 +1,15 @@
 import argparse
+import csv
+import heapq
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 
 from openai import OpenAI
 
+TOP_WORDS_COUNT = 10000
+
 
 @dataclass
 class Word:
@@ -14,10 +18,8 @@ class Word:
     pos: Optional[str] = None
 
 
-@dataclass
-class Freq:
-    freq: float
-    pos: str
+# (frequency, part of speech)
+Freq = Tuple[float, str]
 
 
 def main():
@@ -35,35 +37,41 @@ def main():
                 words.append(Word(word=line))
 
     freq: Dict[str, Freq] = {}
-    with open(args.freq_file, "r") as f:
-        for i, line in enumerate(f):
-            line = line.strip()
-            if line and not line.startswith("#"):
-                parts = line.split("\t")
-                if parts[0] == "unknown":
-                    continue
-                if len(parts) != 4:
-                    raise ValueError("Invalid line {} '{}'".format(i, line))
-                if parts[0] != parts[1]:
-                    continue
-                freq[parts[0]] = Freq(freq=float(parts[3]), pos=parts[2])
+    # Rows are split by the C csv parser, no quoting in the freq file
+    with open(args.freq_file, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+        for i, parts in enumerate(reader):
+            if not parts:
+                continue
+            # Same as stripping the whole line: blank lines are skipped, indented comments kept
+            parts[0] = parts[0].lstrip()
+            parts[-1] = parts[-1].rstrip()
+            if not "".join(parts) or parts[0].startswith("#"):
+                continue
+            if parts[0] == "unknown":
+                continue
+            if len(parts) != 4:
+                raise ValueError("Invalid line {} '{}'".format(i, "\t".join(parts)))
+            if parts[0] != parts[1]:
+                continue
+            freq[parts[0]] = (float(parts[3]), parts[2])
 
     found_freq = 0
     for word in words:
-        if word.word in freq:
-            word.freq = freq[word.word].freq
-            word.pos = freq[word.word].pos
+        word_freq = freq.get(word.word)
+        if word_freq is not None:
+            word.freq, word.pos = word_freq
             found_freq += 1
 
     print("Found {} words with frequencies".format(found_freq))
-    words = sorted(words, key=lambda x: x.freq or 0, reverse=True)
+    # Only the top words need ordering, the rest keeps the input order
+    top_words = heapq.nlargest(TOP_WORDS_COUNT, words, key=lambda x: x.freq or 0)
+    top_word_ids = {id(word) for word in top_words}
+    rest_words = [word for word in words if id(word) not in top_word_ids]
     with open(args.output_file, "w") as f:
-        for i, word in enumerate(words):
-            f.write("{};{};{};\n".format(
-                word.word,
-                word.freq or 0,
-                1 if i < 10000 else 0,
-            ))
+        for words_part, is_top in ((top_words, 1), (rest_words, 0)):
+            for word in words_part:
+                f.write("{};{};{};\n".format(word.word, word.freq or 0, is_top))
 
 
 if __name__ == "__main__":